@@ -7,9 +7,11 @@ from multiprocessing import Process, Lock, Value, Manager
 import swiftclient
 
 import olrcdb
+import timing
 
 # Settings
 SEGMENT_SIZE = 100 * 10 ** 6
+BATCH_SIZE = 1000  # Entries read from the database at a time.
 COUNT = 0
 FAILED_COUNT = 0
 SLEEP = 1  # Sleep timeout when trying to connect to the database.
@@ -36,7 +38,8 @@ def upload_file(path, connection_storage_url, auth_token, container, path_cutoff
     """Given String source_file, upload the file to the OLRC to target_file
      and return True if successful. """
     try:
-        opened_source_file = open(path, 'rb')
+        with timing.span('open'):
+            opened_source_file = open(path, 'rb')
     except IOError as e:
         try:
             print("Error opening %s: %s" % (path, str(e)))
@@ -56,12 +59,13 @@ def upload_file(path, connection_storage_url, auth_token, container, path_cutoff
         swift_path = swift_path[1:]
 
     try:
-        swiftclient.client.put_object(
-            connection_storage_url,
-            auth_token,
-            container,
-            swift_path,
-            opened_source_file)
+        with timing.span('put'):
+            swiftclient.client.put_object(
+                connection_storage_url,
+                auth_token,
+                container,
+                swift_path,
+                opened_source_file)
     except (UnicodeDecodeError, ConnectionError, swiftclient.client.ClientException) as e:
         sys.stderr.flush()
         sys.stderr.write(
@@ -86,11 +90,12 @@ def olrc_connect():
     swift_auth_url, username, password, identity_api_version, os_options = get_env_vars()
 
     try:
-        return swiftclient.client.get_auth(
-            swift_auth_url, username, password,
-            auth_version=identity_api_version,
-            os_options=os_options
-        )
+        with timing.span('auth'):
+            return swiftclient.client.get_auth(
+                swift_auth_url, username, password,
+                auth_version=identity_api_version,
+                os_options=os_options
+            )
     except swiftclient.client.ClientException as e:
         print(e)
         sys.stdout.flush()
@@ -161,104 +166,127 @@ def get_env_vars():
     return swift_auth_url, username, password, identity_api_version, os_options
 
 
+def upload_entry(lock, cur_entry, table_name, container, counter, failed_counter, connection_storage_url,
+                 auth_token, path_cutoff="", reconnect=None):
+    """
+    Upload a single (id, path) entry of table_name, retrying up to 5 times and
+    re-authenticating between attempts. Update counter or failed_counter and
+    return the storage url and auth token to use for the next upload.
+
+    reconnect is called with the stale auth token when a new token is needed.
+    It defaults to olrc_connect.
+    """
+
+    # Paths are stored as raw bytes.
+    path = os.fsdecode(cur_entry[1])
+    retry = 0
+    success = False
+
+    while retry < 5 and not success:
+        # If the upload is successful, update the database
+        if upload_file(path, connection_storage_url, auth_token, container, path_cutoff=path_cutoff):
+            lock.acquire()
+            counter.value += 1
+            lock.release()
+            set_uploaded(cur_entry[0], table_name)
+            success = True
+        else:
+            retry += 1
+            time.sleep(1)
+            if reconnect is None:
+                connection_storage_url, auth_token = olrc_connect()
+            else:
+                connection_storage_url, auth_token = reconnect(auth_token)
+
+    if not success:
+        lock.acquire()
+        sys.stdout.flush()
+        sys.stdout.write(
+            "Error! {0} Upload of {1} to OLRC failed"
+            " after {2} attempts.\n".format(
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
+                path,
+                retry
+            )
+        )
+
+        failed_counter.value += 1
+        error_log = open(LOGDIR + table_name + '.upload.error.log', 'a')
+        error_log.write(
+            "\rFailed: {0}\n".format(
+                path.encode('utf-8', 'surrogateescape')))
+        error_log.close()
+        lock.release()
+
+    return connection_storage_url, auth_token
+
+
 def upload_table(lock, table_name, container, counter, failed_counter, speed, connection_storage_url,
-                 auth_token, entries, path_cutoff=""):
+                 auth_token, entries, last_id, path_cutoff=""):
     """
     Given a table_name, upload all the paths from the table where upload is 0.
-    Using the range value, complete a BATCH worth of uploads at a time.
+    Entries are shared with the other processes and refilled a BATCH_SIZE
+    at a time, after last_id, by whichever process finds them empty.
     """
 
+    # In order for the current process to upload a unique set of files,
+    # acquire the lock to pop from entries.
+    @timing.timed('pop')
     def get_entry():
+        lock.acquire()
         try:
+            if not load_entries(table_name, entries, last_id):
+                return None
             return entries.pop()
-        except IndexError:
-            return None
+        finally:
+            lock.release()
 
     global FAILED_COUNT
 
     total = get_total_to_upload(table_name)
 
-    # In order for the current process to upload a unique set of files,
-    # acquire the lock to read from range's value.
-    lock.acquire()
     cur_entry = get_entry()
-    lock.release()
 
     while cur_entry is not None:
-        retry = 0
-        success = False
-
-        while retry < 5 and not success:
-            # If the upload is successful, update the database
-            if upload_file(cur_entry[1], connection_storage_url, auth_token, container, path_cutoff=path_cutoff):
-                lock.acquire()
-                counter.value += 1
-                lock.release()
-                set_uploaded(cur_entry[0], table_name)
-                success = True
-            else:
-                retry += 1
-                time.sleep(1)
-                connection_storage_url, auth_token = olrc_connect()
-
-        if not success:
-            lock.acquire()
-            sys.stdout.flush()
-            sys.stdout.write(
-                "Error! {0} Upload of {1} to OLRC failed"
-                " after {2} attempts.\n".format(
-                    time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()),
-                    cur_entry[1],
-                    retry
-                )
-            )
-
-            failed_counter.value += 1
-            error_log = open(LOGDIR + table_name + '.upload.error.log', 'a')
-            error_log.write(
-                "\rFailed: {0}\n".format(
-                    cur_entry[1].encode('utf-8')))
-            error_log.close()
-            lock.release()
+        connection_storage_url, auth_token = upload_entry(
+            lock, cur_entry, table_name, container, counter, failed_counter,
+            connection_storage_url, auth_token, path_cutoff=path_cutoff)
 
         print_status(counter, lock, speed, table_name, total)
 
-        lock.acquire()
         cur_entry = get_entry()
-        lock.release()
 
 
 def get_total_to_upload(table_name):
-    """Given a table_name, get the total number of rows"""
-
-    query = "SELECT COUNT(*) FROM {0}".format(table_name)
+    """Given a table_name, get the total number of rows from its progress
+    counters."""
 
     connect = olrcdb.DatabaseConnection()
-    result = connect.execute_query(query)
-    result_tuple = result.fetchone()
-    return result_tuple[0]
+    return connect.get_counts(table_name)[0]
 
 
 def get_total_uploaded(table_name):
-    """Given a table_name, get the total number of rows where upload is 1."""
-
-    query = "SELECT COUNT(*) FROM {0} WHERE uploaded=1".format(table_name)
+    """Given a table_name, get the total number of rows where upload is 1
+    from its progress counters."""
 
     connect = olrcdb.DatabaseConnection()
-    result = connect.execute_query(query)
-    result_tuple = result.fetchone()
-    return result_tuple[0]
+    return connect.get_counts(table_name)[1]
 
 
+@timing.timed('db')
 def set_uploaded(id, table_name):
     """For the given path, set uploaded to 1 in table_name."""
-    query = "UPDATE {0} set uploaded='1' WHERE id='{1}'".format(
-        table_name,
-        id
-    )
 
     connect = olrcdb.DatabaseConnection()
-    connect.execute_query(query)
+    connect.set_uploaded(id, table_name)
+
+
+def migrate_table(table_name):
+    """Bring table_name up to the current schema if it was created by an
+    older prepareupload.py."""
+
+    connect = olrcdb.DatabaseConnection()
+    connect.migrate_table(table_name)
 
 
 def check_env_args():
@@ -298,8 +326,12 @@ def start_reporting(table_name):
     error_log.close()
 
 
-def end_reporting(counter, failed_counter, table_name):
-    """Create a report log. Output upload summary."""
+def end_reporting(counter, failed_counter, table_name, timings=None, profile_paths=None):
+    """Create a report log. Output upload summary.
+
+    If given, timings is a list of stage totals from the workers and
+    profile_paths the cProfile dumps of the workers, both of which are
+    merged into the report."""
 
     report_log = open(LOGDIR + table_name + '.upload.report.log', 'w+')
     report_log.write("From execution {0}:\n".format(
@@ -309,6 +341,11 @@ def end_reporting(counter, failed_counter, table_name):
              "Failed uploads stored in error.log\n" \
              "Reported saved in report.log.\n" \
         .format(counter.value, failed_counter.value)
+    if timings:
+        report += timing.format_report(timing.merge(timings))
+    if profile_paths:
+        report += timing.merge_profiles(
+            profile_paths, LOGDIR + table_name + '.upload.prof')
     report_log.write(report)
     report_log.close()
 
@@ -317,6 +354,7 @@ def end_reporting(counter, failed_counter, table_name):
     sys.stdout.write(report)
 
 
+@timing.timed('status')
 def print_status(counter, lock, speed, table_name, total):
     """Print the current status of uploaded files."""
     lock.acquire()
@@ -327,8 +365,9 @@ def print_status(counter, lock, speed, table_name, total):
     lock.release()
 
     sys.stdout.flush()
-    sys.stdout.write("\r{0}% Uploaded at {1:.2f} uploads/second. ".format(
-        percentage_uploaded, speed.value))
+    # Name the table since several tables may share the terminal.
+    sys.stdout.write("\r{0}: {1}% Uploaded at {2:.2f} uploads/second. ".format(
+        table_name, percentage_uploaded, speed.value))
 
     # Log the final count
     report = open(LOGDIR + table_name + ".upload.out", 'w+')
@@ -351,20 +390,41 @@ def get_min_id(table_name):
     return int(result_tuple[0])
 
 
-def get_all_entries_to_upload():
-    """Return a tuple of all database entries that need to be uploaded."""
-    # We order the entries descending because we are going to be popping this list (i.e. starting by the end)
-    query = "SELECT * FROM {0} WHERE uploaded=0 ORDER BY id DESC".format(table_name)
+def get_entries_to_upload(table_name, after_id, limit=BATCH_SIZE):
+    """Return a tuple of at most limit (id, path) entries of table_name that
+    need to be uploaded and whose id is greater than after_id, in id
+    order."""
+    query = "SELECT id, path FROM {0} WHERE uploaded=0 AND id > %s " \
+            "ORDER BY id LIMIT %s".format(table_name)
     connect = olrcdb.DatabaseConnection()
-    result = connect.execute_query(query)
+    result = connect.execute_query(query, (after_id, limit))
     return result.fetchall()
 
 
-def set_speed(lock, counter, speed, entries):
+def load_entries(table_name, entries, last_id):
+    """If the shared list entries is empty, refill it with the next batch of
+    entries of table_name after last_id and advance last_id. Return False if
+    there is nothing left to upload. Must be called with the lock held."""
+
+    if entries:
+        return True
+
+    batch = get_entries_to_upload(table_name, last_id.value)
+    if not batch:
+        return False
+
+    last_id.value = batch[-1][0]
+    # Entries are popped from the end, so store the batch in reverse to
+    # upload in id order.
+    entries.extend(reversed(batch))
+    return True
+
+
+def set_speed(lock, counter, speed, done):
     """Calculate the upload speed for the next minute and set it in the
-    speed."""
+    speed until done is set."""
 
-    while entries:
+    while not done.value:
         lock.acquire()
         start_count = counter.value
         start_time = time.time()
@@ -403,6 +463,7 @@ if __name__ == "__main__":
     create_container(storage_url, auth_token, container)
 
     start_reporting(table_name)
+    migrate_table(table_name)
 
     manager = Manager()
     # Integer value of uploaded files within target table.
@@ -410,18 +471,30 @@ if __name__ == "__main__":
     failed_counter = Value("i", 0)
     lock = Lock()
 
-    # Load entries into manager list
-    entries = manager.list(get_all_entries_to_upload())
+    # Entries are loaded into the manager list in batches by the workers.
+    entries = manager.list()
+    last_id = Value("i", 0)  # Id of the last entry loaded into entries.
 
     speed = Value("d", 0.0)  # Tracker for upload speed.
 
+    timings = manager.list()  # Stage timings reported by each process.
+    profile_paths = []
+
     processes = []
 
     # Create a new process n times.
     for process in range(n_processes):
+        profile_path = None
+        if timing.profiling_enabled():
+            profile_path = LOGDIR + table_name + '.upload.{0}.prof'.format(process)
+            profile_paths.append(profile_path)
+
         p = Process(
-            target=upload_table,
+            target=timing.run_worker,
             args=(
+                timings,
+                profile_path,
+                upload_table,
                 lock,
                 table_name,
                 container,
@@ -430,7 +503,8 @@ if __name__ == "__main__":
                 speed,
                 storage_url,
                 auth_token,
-                entries
+                entries,
+                last_id
             ),
             kwargs={"path_cutoff": path_cutoff}
         )
@@ -440,19 +514,22 @@ if __name__ == "__main__":
         processes.append(p)
 
     # Create a process to calculate the speed of uploads.
-    p = Process(
+    done = Value("b", 0)  # Set once every upload process has finished.
+    speed_process = Process(
         target=set_speed,
         args=(
             lock,
             counter,
             speed,
-            entries
+            done
         ))
-    p.start()
-    processes.append(p)
+    speed_process.start()
 
     # Join all processes
     for process in processes:
         process.join()
 
-    end_reporting(counter, failed_counter, table_name)
+    done.value = 1
+    speed_process.join()
+
+    end_reporting(counter, failed_counter, table_name, timings, profile_paths)
@@ -0,0 +1,298 @@
+import math
+import os
+import sys
+import time
+from multiprocessing import Process, Lock, Value, Array, Manager
+
+import timing
+from bulkupload import (
+    LOGDIR,
+    REQUIRED_VARIABLES,
+    create_container,
+    end_reporting,
+    env_vars_set,
+    get_total_to_upload,
+    get_total_uploaded,
+    load_entries,
+    migrate_table,
+    olrc_connect,
+    print_status,
+    start_reporting,
+    upload_entry,
+)
+
+# Pass value of a job with nothing left to hand out.
+DONE = float("inf")
+# Bytes charged to a job for every file on top of its size, so that jobs of
+# tiny files pay for the per-request overhead of each upload.
+PER_FILE_COST = 100 * 1024
+
+
+def read_job_file(job_file):
+    """Given the path to a job file, return a list of job dicts.
+
+    Each non-empty line not starting with # describes one job as
+    whitespace separated fields:
+        container-name mysql-table [weight [path-cutoff]]
+    where weight is the job's relative share of the worker pool (default 1).
+    """
+
+    jobs = []
+    table_names = set()
+    with open(job_file) as f:
+        for line_number, line in enumerate(f, 1):
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) < 2 or len(fields) > 4:
+                sys.exit("Invalid job on line {0} of {1}: {2}".format(
+                    line_number, job_file, line.strip()))
+
+            try:
+                weight = float(fields[2]) if len(fields) > 2 else 1.0
+            except ValueError:
+                weight = 0
+            if not (math.isfinite(weight) and weight > 0):
+                sys.exit("Weight on line {0} of {1} needs to be a finite"
+                         " positive number. Got {2} instead.".format(
+                             line_number, job_file, fields[2]))
+
+            # Two jobs over one table would hand out the same rows twice.
+            if fields[1] in table_names:
+                sys.exit("Table {0} is listed twice on line {1} of {2}".format(
+                    fields[1], line_number, job_file))
+            table_names.add(fields[1])
+
+            jobs.append({
+                "container": fields[0],
+                "table_name": fields[1],
+                "weight": weight,
+                "path_cutoff": fields[3] if len(fields) > 3 else '',
+            })
+
+    if not jobs:
+        sys.exit("No jobs found in {0}".format(job_file))
+
+    return jobs
+
+
+def next_entry(jobs, passes):
+    """Return (job index, entry) for the next entry to upload, or None when
+    every job is exhausted. Must be called with the scheduling lock held.
+    A job's entries are read from its table a batch at a time as they run
+    out.
+
+    Jobs are picked by stride scheduling: the job with the lowest pass value
+    goes next and its pass is advanced by PER_FILE_COST divided by the job's
+    weight. The worker then adds the size of the file through charge_size.
+    Each job with work left therefore gets a share of the bytes uploaded,
+    and so roughly of the workers' time, proportional to its weight
+    regardless of how many files it has. The share of a finished job goes
+    to the others."""
+
+    while True:
+        index = None
+        for i in range(len(jobs)):
+            if passes[i] != DONE and (index is None or passes[i] < passes[index]):
+                index = i
+
+        if index is None:
+            return None
+
+        job = jobs[index]
+        if not load_entries(job["table_name"], job["entries"], job["last_id"]):
+            passes[index] = DONE
+            continue
+
+        entry = job["entries"].pop()
+
+        passes[index] += float(PER_FILE_COST) / job["weight"]
+        return index, entry
+
+
+def file_size(path):
+    """Return the size of the file at path, or 0 if it can't be read. The
+    upload of such a file will fail and be logged."""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
+def charge_size(jobs, passes, index, size):
+    """Advance the pass of job index by size bytes divided by its weight.
+    Must be called with the scheduling lock held."""
+    passes[index] += float(size) / jobs[index]["weight"]
+
+
+def upload_jobs(lock, jobs, passes, auth_lock, auth_cache):
+    """Upload entries from all jobs until every job is exhausted, sharing
+    the auth token in auth_cache with the other workers."""
+
+    def reconnect(stale_token):
+        # Only re-authenticate if no other worker has refreshed the token
+        # since we last read it. Time spent waiting for another worker to
+        # re-authenticate is counted as auth_wait.
+        with timing.span('auth_wait'):
+            auth_lock.acquire()
+        try:
+            if auth_cache["auth_token"] == stale_token:
+                storage_url, auth_token = olrc_connect()
+                auth_cache["storage_url"] = storage_url
+                auth_cache["auth_token"] = auth_token
+            return auth_cache["storage_url"], auth_cache["auth_token"]
+        finally:
+            auth_lock.release()
+
+    @timing.timed('pop')
+    def get_entry():
+        lock.acquire()
+        try:
+            return next_entry(jobs, passes)
+        finally:
+            lock.release()
+
+    connection_storage_url = auth_cache["storage_url"]
+    auth_token = auth_cache["auth_token"]
+
+    scheduled = get_entry()
+
+    while scheduled is not None:
+        index, cur_entry = scheduled
+        job = jobs[index]
+
+        # Stat outside the lock so that slow storage does not hold up the
+        # other workers.
+        size = file_size(cur_entry[1])
+        lock.acquire()
+        charge_size(jobs, passes, index, size)
+        lock.release()
+
+        connection_storage_url, auth_token = upload_entry(
+            lock, cur_entry, job["table_name"], job["container"],
+            job["counter"], job["failed_counter"], connection_storage_url,
+            auth_token, path_cutoff=job["path_cutoff"], reconnect=reconnect)
+
+        print_status(job["counter"], lock, job["speed"], job["table_name"],
+                     job["total"])
+
+        scheduled = get_entry()
+
+
+def set_speeds(lock, jobs, done):
+    """Calculate the upload speed of every job every 5 seconds and set it in
+    the job's speed until done is set."""
+
+    while not done.value:
+        lock.acquire()
+        start_counts = [job["counter"].value for job in jobs]
+        start_time = time.time()
+        lock.release()
+
+        time.sleep(5)
+
+        lock.acquire()
+        stop_time = time.time()
+        for job, start_count in zip(jobs, start_counts):
+            job["speed"].value = (
+                    float(job["counter"].value - start_count) /
+                    float(stop_time - start_time)
+            )
+        lock.release()
+
+
+def check_env_args():
+    """Do checks on the environment and args."""
+    if not env_vars_set(REQUIRED_VARIABLES):
+        set_env_message = "The following environment variables need to be " \
+                          "set:\n"
+        set_env_message += " \n".join(REQUIRED_VARIABLES)
+        set_env_message += "\nPlease set these environment variables to " \
+                           "connect to the OLRC."
+        print(set_env_message)
+        exit(0)
+
+    usage = "Please pass in a few arguments, see example below \n" \
+            "python multiupload.py job-file n-processes\n" \
+            "where job-file lists one job per line as\n" \
+            "container-name mysql-table [weight [path-cutoff]]\n" \
+            "and n-processes is the number of processes shared by all jobs."
+
+    if len(sys.argv) != 3:
+        print(usage)
+        exit(0)
+
+
+if __name__ == "__main__":
+
+    check_env_args()
+
+    job_file = sys.argv[1]
+    jobs = read_job_file(job_file)  # Jobs sharing the worker pool.
+    n_processes = int(sys.argv[2])  # Number of processes shared by all jobs.
+
+    # Authenticate once; workers refresh this shared token when it expires.
+    manager = Manager()
+    storage_url, auth_token = olrc_connect()
+    auth_cache = manager.dict(storage_url=storage_url, auth_token=auth_token)
+    auth_lock = Lock()
+    lock = Lock()
+
+    for job in jobs:
+        create_container(storage_url, auth_token, job["container"])
+        start_reporting(job["table_name"])
+        migrate_table(job["table_name"])
+
+        job["total"] = get_total_to_upload(job["table_name"])
+        job["counter"] = Value("i", get_total_uploaded(job["table_name"]))
+        job["failed_counter"] = Value("i", 0)
+        job["speed"] = Value("d", 0.0)
+        job["entries"] = manager.list()  # Loaded in batches by next_entry.
+        job["last_id"] = Value("i", 0)
+
+    # Stride scheduling pass values, one per job.
+    passes = Array("d", len(jobs), lock=False)
+
+    # Timings and profiles are reported for the pool as a whole since every
+    # worker uploads for every job.
+    report_name = LOGDIR + os.path.basename(job_file)
+    timings = manager.list()  # Stage timings reported by each process.
+    profile_paths = []
+
+    processes = []
+
+    for process in range(n_processes):
+        profile_path = None
+        if timing.profiling_enabled():
+            profile_path = report_name + '.upload.{0}.prof'.format(process)
+            profile_paths.append(profile_path)
+
+        p = Process(
+            target=timing.run_worker,
+            args=(timings, profile_path, upload_jobs,
+                  lock, jobs, passes, auth_lock, auth_cache)
+        )
+        p.start()
+        processes.append(p)
+
+    done = Value("b", 0)  # Set once every upload process has finished.
+    speed_process = Process(target=set_speeds, args=(lock, jobs, done))
+    speed_process.start()
+
+    for process in processes:
+        process.join()
+
+    done.value = 1
+    speed_process.join()
+
+    for job in jobs:
+        end_reporting(job["counter"], job["failed_counter"], job["table_name"])
+
+    report = timing.format_report(timing.merge(timings))
+    report += timing.merge_profiles(profile_paths, report_name + '.upload.prof')
+    timing_log = open(report_name + '.upload.timing.log', 'w+')
+    timing_log.write(report)
+    timing_log.close()
+
+    sys.stdout.flush()
+    sys.stdout.write(report)
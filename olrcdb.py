@@ -2,6 +2,9 @@ import os
 import sys
 import pymysql
 
+# Table holding one row of progress counters per upload table.
+SUMMARY_TABLE = "upload_summary"
+
 
 class DatabaseConnection(object):
     """Connect to OLRCs mysql server."""
@@ -33,47 +36,154 @@ class DatabaseConnection(object):
 
         return self.cursor
 
+    def create_summary_table(self):
+        """Create the table of progress counters if it does not exist."""
+
+        query = "CREATE TABLE IF NOT EXISTS {0} ( \
+            table_name VARCHAR(64) NOT NULL,\
+            total BIGINT UNSIGNED NOT NULL DEFAULT 0,\
+            uploaded BIGINT UNSIGNED NOT NULL DEFAULT 0,\
+            PRIMARY KEY (table_name)\
+            ) ENGINE=InnoDB".format(SUMMARY_TABLE)
+
+        self.execute_query(query)
+
     def create_table(self, table_name):
-        """Given a table_name, create a table in the database. """
+        """Given a table_name, create a table in the database and its row of
+        progress counters.
+
+        Paths are stored as raw bytes so that any file name can be stored.
+        Rows are looked up by the primary key and the files left to upload
+        are read in id order from the (uploaded, id) index."""
 
         query = "CREATE TABLE {0} ( \
-            `id` INTEGER  NOT NULL AUTO_INCREMENT,\
-            path VARCHAR(1000),\
+            `id` INTEGER NOT NULL AUTO_INCREMENT,\
+            path VARBINARY(4096),\
             uploaded BOOL DEFAULT '0',\
-            INDEX `path_index` (`id`)\
-            )".format(table_name)
+            PRIMARY KEY (`id`),\
+            INDEX `uploaded_index` (`uploaded`, `id`)\
+            ) ENGINE=InnoDB".format(table_name)
 
         try:
+            self.create_summary_table()
             self.cursor.execute(query)
+            self.cursor.execute(
+                "INSERT INTO {0} (table_name) VALUES (%s) "
+                "ON DUPLICATE KEY UPDATE total=0, uploaded=0".format(
+                    SUMMARY_TABLE),
+                (table_name,)
+            )
+            self.db.commit()
         except pymysql.Error as e:
             sys.exit("ERROR {0} IN TABLE CREATION: {1}".format(
                 e.args[0],
                 e.args[1]
             ))
 
-    def insert_path(self, path, table_name, alt=False):
-        """Insert the given path to the table_name. If alt, create
-        the query with reversed quotes."""
+    def migrate_table(self, table_name):
+        """Bring a table_name created with the old schema, which has no
+        primary key and no progress counters, up to the current schema in
+        place. Do nothing if it is already up to date."""
 
-        if not alt:
-            query = "INSERT INTO {0} (path) VALUES ('{1}');".format(
-                table_name,
-                path
+        self.create_summary_table()
+
+        primary_key = self.execute_query(
+            "SHOW KEYS FROM {0} WHERE Key_name='PRIMARY'".format(table_name)
+        ).fetchone()
+        if not primary_key:
+            # Old paths are stored in the server's default character set,
+            # such as latin1. Convert them to UTF-8 before keeping the raw
+            # bytes, so they match the paths insert_path writes.
+            self.execute_query(
+                "ALTER TABLE {0} \
+                MODIFY path VARCHAR(1000) CHARACTER SET utf8mb4".format(
+                    table_name)
+            )
+            self.execute_query(
+                "ALTER TABLE {0} \
+                MODIFY path VARBINARY(4096),\
+                DROP INDEX `path_index`,\
+                ADD PRIMARY KEY (`id`),\
+                ADD INDEX `uploaded_index` (`uploaded`, `id`)".format(
+                    table_name)
             )
-        else:
-            query = 'INSERT INTO {0} (path) VALUES ("{1}");'.format(
-                table_name,
-                path
+
+        summary = self.execute_query(
+            "SELECT 1 FROM {0} WHERE table_name=%s".format(SUMMARY_TABLE),
+            (table_name,)
+        ).fetchone()
+        if not summary:
+            # One last full count to seed the counters.
+            self.execute_query(
+                "INSERT INTO {0} (table_name, total, uploaded) "
+                "SELECT %s, COUNT(*), COALESCE(SUM(uploaded=1), 0) "
+                "FROM {1}".format(SUMMARY_TABLE, table_name),
+                (table_name,)
             )
 
-        self.cursor.execute(query)
-        self.db.commit()
+    def get_counts(self, table_name):
+        """Return (total, uploaded), the number of paths in table_name and
+        how many of them are uploaded."""
+
+        result = self.execute_query(
+            "SELECT total, uploaded FROM {0} WHERE table_name=%s".format(
+                SUMMARY_TABLE),
+            (table_name,)
+        ).fetchone()
+        if not result:
+            sys.exit("No progress counters for table {0}".format(table_name))
+        return int(result[0]), int(result[1])
 
-    def execute_query(self, query):
-        """Execute the given query and return the cursor object."""
+    def insert_path(self, path, table_name):
+        """Insert the given path to the table_name and count it in the
+        table's total."""
 
         try:
-            self.cursor.execute(query)
+            self.cursor.execute(
+                "INSERT INTO {0} (path) VALUES (%s)".format(table_name),
+                (os.fsencode(path),)
+            )
+            self.cursor.execute(
+                "UPDATE {0} SET total=total+1 WHERE table_name=%s".format(
+                    SUMMARY_TABLE),
+                (table_name,)
+            )
+            self.db.commit()
+        except pymysql.Error:
+            self.db.rollback()
+            raise
+
+    def set_uploaded(self, id, table_name):
+        """Set uploaded to 1 for the row id of table_name and count it in the
+        table's uploaded total, unless it was already uploaded."""
+
+        try:
+            changed = self.cursor.execute(
+                "UPDATE {0} SET uploaded=1 WHERE id=%s AND uploaded=0".format(
+                    table_name),
+                (id,)
+            )
+            if changed:
+                self.cursor.execute(
+                    "UPDATE {0} SET uploaded=uploaded+1 "
+                    "WHERE table_name=%s".format(SUMMARY_TABLE),
+                    (table_name,)
+                )
+            self.db.commit()
+        except pymysql.Error as e:
+            self.db.rollback()
+            sys.exit("ERROR {0} IN QUERY: {1}\nQuery:set_uploaded {2}".format(
+                e.args[0],
+                e.args[1],
+                id
+            ))
+
+    def execute_query(self, query, args=None):
+        """Execute the given query with the optional args and return the
+        cursor object."""
+
+        try:
+            self.cursor.execute(query, args)
             self.db.commit()
         except pymysql.Error as e:
             sys.exit("ERROR {0} IN QUERY: {1}\nQuery:{2}".format(
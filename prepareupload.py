@@ -4,6 +4,8 @@ import os
 
 import datetime
 
+import timing
+
 from bulkupload import env_vars_set
 
 # Globals
@@ -27,19 +29,18 @@ def prepare_upload(connect, directory, table_name):
     global COUNT, FAILED
 
     # Loop through all items in the directory.
-    for filename in os.listdir(directory):
+    with timing.span('listdir'):
+        filenames = os.listdir(directory)
+
+    for filename in filenames:
 
         file_path = os.path.join(directory, filename)
 
         # Add file name to the list.
         if os.path.isfile(file_path):
-            try:
-                connect.insert_path(file_path, table_name)
-                COUNT += 1
-            except:
-                # Try again with the alternative query.
+            with timing.span('insert'):
                 try:
-                    connect.insert_path(file_path, table_name, True)
+                    connect.insert_path(file_path, table_name)
                     COUNT += 1
                 except:
 
@@ -47,13 +48,15 @@ def prepare_upload(connect, directory, table_name):
                     error_log = open(table_name + '.prepare.error.log', 'a')
                     error_log.write("\rFailed: {0}\n".format(file_path))
                     error_log.close()
-            sys.stdout.flush()
-            sys.stdout.write("\r{0} parsed. ".format(COUNT))
 
-            # Output status to a file.
-            final_count = open(table_name + ".prepare.out", 'w+')
-            final_count.write("\r{0} parsed. ".format(COUNT))
-            final_count.close()
+            with timing.span('status'):
+                sys.stdout.flush()
+                sys.stdout.write("\r{0} parsed. ".format(COUNT))
+
+                # Output status to a file.
+                final_count = open(table_name + ".prepare.out", 'w+')
+                final_count.write("\r{0} parsed. ".format(COUNT))
+                final_count.close()
 
         # Recursive call for sub directories.
         else:
@@ -102,3 +105,10 @@ if __name__ == "__main__":
     final_count = open(table_name + ".prepare.out", 'w+')
     final_count.write("\r{0} parsed. ".format(COUNT))
     final_count.close()
+
+    # Log where the time went.
+    report = timing.format_report(timing.collect())
+    timing_log = open(table_name + ".prepare.timing.log", 'w+')
+    timing_log.write(report)
+    timing_log.close()
+    sys.stdout.write(report)
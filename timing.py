@@ -0,0 +1,125 @@
+import cProfile
+import os
+import pstats
+from contextlib import contextmanager
+from functools import wraps
+from io import StringIO
+from time import perf_counter
+
+# Set this environment variable to run cProfile in every upload worker.
+PROFILE_VARIABLE = 'UPLOAD_PROFILE'
+
+# Stage name -> [count, total seconds] for the current process.
+_totals = {}
+
+
+@contextmanager
+def span(stage):
+    """Time the enclosed block and add it to the totals of stage."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        total = _totals.get(stage)
+        if total is None:
+            _totals[stage] = [1, elapsed]
+        else:
+            total[0] += 1
+            total[1] += elapsed
+
+
+def timed(stage):
+    """Decorator timing every call of the function as stage."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def reset():
+    """Clear the totals of the current process."""
+    _totals.clear()
+
+
+def collect():
+    """Return a copy of the totals of the current process."""
+    return dict((stage, list(total)) for stage, total in _totals.items())
+
+
+def merge(all_totals):
+    """Given an iterable of totals from several processes, return their
+    sum."""
+    merged = {}
+    for totals in all_totals:
+        for stage, (count, seconds) in totals.items():
+            total = merged.setdefault(stage, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+    return merged
+
+
+def format_report(totals):
+    """Return a human readable summary of totals, slowest stage first."""
+    report = "\nTime per stage (summed over all processes):\n"
+    for stage, (count, seconds) in sorted(
+            totals.items(), key=lambda item: item[1][1], reverse=True):
+        report += "{0:<10} {1:>10} calls {2:>12.2f}s total {3:>10.3f}ms mean\n" \
+            .format(stage, count, seconds, seconds / count * 1000)
+    return report
+
+
+def profiling_enabled():
+    """Return True if workers should be run under cProfile."""
+    return bool(os.environ.get(PROFILE_VARIABLE))
+
+
+def run_worker(timings, profile_path, target, *args, **kwargs):
+    """Run target(*args, **kwargs) as the body of a worker process.
+
+    Once target returns, append the stage totals of this process to the
+    shared list timings. If profile_path is given, target is run under
+    cProfile and its stats are dumped to profile_path."""
+
+    # A forked worker inherits the totals of its parent.
+    reset()
+
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        target(*args, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        timings.append(collect())
+
+
+def merge_profiles(profile_paths, merged_path, limit=40):
+    """Merge the cProfile dumps in profile_paths into merged_path, remove
+    the individual dumps and return a report of the top limit functions by
+    cumulative time. Return an empty string if there is nothing to merge."""
+
+    profile_paths = [path for path in profile_paths if os.path.exists(path)]
+    if not profile_paths:
+        return ""
+
+    stream = StringIO()
+    stats = pstats.Stats(*profile_paths, stream=stream)
+    stats.dump_stats(merged_path)
+    stats.sort_stats('cumulative').print_stats(limit)
+
+    for path in profile_paths:
+        os.remove(path)
+
+    return "\nProfile of all workers (full stats in {0}):\n{1}".format(
+        merged_path, stream.getvalue())